@@ -22,7 +22,7 @@ def get_identity_basis_func():
 def get_poly_basis_func(degree):
     return BasisFunction(n_args=1,
             func =      lambda x : x**degree,
-            grad_func = lambda x : [x**(degree-1)],
+            grad_func = lambda x : [degree * x**(degree-1)],
             name_func = lambda x : "{}**{}".format(x,degree))
 
 def get_cross_term_basis_funcs(degree):
@@ -3,6 +3,7 @@ import numpy.linalg as la
 import scipy.linalg as sla
 from pdb import set_trace
 from sklearn.linear_model import  Lasso
+from joblib import Parallel, delayed, effective_n_jobs
 
 from .model import Model, ModelFactory
 from .stable_koopman import stabilize_discrete
@@ -11,6 +12,65 @@ import ConfigSpace as CS
 import ConfigSpace.hyperparameters as CSH
 import ConfigSpace.conditions as CSC
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Integer codes for basis function kinds, used by the compiled kernel
+_BASIS_KINDS = {"id" : 0, "pow" : 1, "sin" : 2, "cos" : 3}
+
+# Generated NumPy basis functions, keyed by basis descriptors and
+# observation dimension.  Kept outside of Koopman so models stay picklable.
+_basis_func_cache = {}
+
+def _get_basis_func(basis, n):
+    """
+    Returns a function apply_basis(obs, out) which writes the basis
+    described by the (kind, param) descriptors into out, with the loop over
+    descriptors unrolled into straight-line NumPy calls.
+    """
+    key = (tuple(basis), n)
+    if key not in _basis_func_cache:
+        src = "def apply_basis(obs, out):\n"
+        for k, (kind, param) in enumerate(basis):
+            block = "out[:, {}:{}]".format(k*n, (k+1)*n)
+            if kind == "id":
+                src += "    {}[...] = obs\n".format(block)
+            elif kind == "pow":
+                src += "    np.power(obs, {}, out={})\n".format(param, block)
+            elif kind == "sin":
+                src += "    np.sin({} * obs, out={})\n".format(param, block)
+            elif kind == "cos":
+                src += "    np.cos({} * obs, out={})\n".format(param, block)
+        namespace = {}
+        exec(compile(src, "<koopman basis>", "exec"), {"np" : np}, namespace)
+        _basis_func_cache[key] = namespace["apply_basis"]
+    return _basis_func_cache[key]
+
+def _fit_lasso_chunk(X, Y, alpha, gram):
+    clf = Lasso(alpha=alpha, fit_intercept=False, precompute=gram)
+    clf.fit(X, Y)
+    return clf.coef_.reshape((Y.shape[1], -1))
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _apply_basis_kernel(obs, kinds, params, out):
+        T, n = obs.shape
+        for t in numba.prange(T):
+            for k in range(kinds.size):
+                base = k*n
+                for i in range(n):
+                    x = obs[t, i]
+                    if kinds[k] == 0:
+                        out[t, base+i] = x
+                    elif kinds[k] == 1:
+                        out[t, base+i] = x ** params[k]
+                    elif kinds[k] == 2:
+                        out[t, base+i] = np.sin(params[k] * x)
+                    else:
+                        out[t, base+i] = np.cos(params[k] * x)
+
 class KoopmanFactory(ModelFactory):
     """
     This class identifies Koopman models of the form :math:`\dot{\Psi}(x) = A\Psi(x) + Bu`. 
@@ -37,6 +97,11 @@ class KoopmanFactory(ModelFactory):
     - *trig_basis* (Type: bool): Whether to use trig basis functions.
     - *trig_freq* (Type: int, Low: 1, High: 8, Default: 1): Maximum frequency of trig functions.
     - *product_terms* (Type: bool): Whether to include cross-product terms.
+
+    Additional keyword arguments:
+
+    - *n_jobs* (Type: int, Default: 1): Number of parallel jobs used to fit the
+      Lasso regression.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -79,10 +144,11 @@ class KoopmanFactory(ModelFactory):
 class Koopman(Model):
     def __init__(self, system, method, lasso_alpha=None, poly_basis=False,
             poly_degree=1, trig_basis=False, trig_freq=1, product_terms=False,
-            use_cuda=None):
+            use_cuda=None, n_jobs=1):
         super().__init__(system)
 
         self.method = method
+        self.n_jobs = n_jobs
         if not lasso_alpha is None:
             self.lasso_alpha = lasso_alpha
         else:
@@ -96,32 +162,49 @@ class Koopman(Model):
         self.trig_basis = trig_basis
         self.trig_freq = trig_freq
         if type(product_terms) == str:
-            self.product_terms = True if product_terms == "true" else False
+            product_terms = True if product_terms == "true" else False
+        self.product_terms = product_terms
 
-        self.basis_funcs = [lambda x: x]
+        # Basis functions are stored as (kind, param) descriptors so that
+        # they can be evaluated over a whole block of observations at once.
+        self.basis = [("id", None)]
         if self.poly_basis:
-            self.basis_funcs += [lambda x: x**i for i in range(2, 1+self.poly_degree)]
+            self.basis += [("pow", i) for i in range(2, 1+self.poly_degree)]
         if self.trig_basis:
-            for i in range(1, 1+self.poly_degree):
-                self.basis_funcs += [lambda x: np.sin(i*x), lambda x : np.cos(i*x)]
+            for i in range(1, 1+self.trig_freq):
+                self.basis += [("sin", i), ("cos", i)]
+        self._basis_kinds = np.array([_BASIS_KINDS[kind] 
+            for kind, _ in self.basis], dtype=np.int64)
+        self._basis_params = np.array([0 if param is None else param 
+            for _, param in self.basis], dtype=np.float64)
+        if self.product_terms:
+            N = len(self.basis) * self.system.obs_dim
+            self._tri_i, self._tri_j = np.triu_indices(N, k=1)
 
     def _apply_basis(self, state):
-        tr_state = [b(x) for b in self.basis_funcs for x in state]
-        if self.product_terms:
-            pr_terms = []
-            for i, x in enumerate(tr_state):
-                for j, y in enumerate(tr_state):
-                    if i < j:
-                        pr_terms.append(x*y)
-            tr_state += pr_terms
+        return self._transform_observations(state.reshape((1,-1)))[0,:]
 
-        return np.array(tr_state)
+    def _apply_basis_numpy(self, observations, out):
+        _get_basis_func(self.basis, observations.shape[1])(observations, out)
 
     def _transform_observations(self, observations):
-        return np.apply_along_axis(self._apply_basis, 1, observations)
+        T, n = observations.shape
+        out = np.empty((T, n*len(self.basis)), dtype=observations.dtype)
+        if numba is not None:
+            # The compiled kernel evaluates every basis slot in one pass
+            # over the observations.  Fall back to NumPy when Numba is
+            # not installed.
+            _apply_basis_kernel(observations, self._basis_kinds,
+                    self._basis_params, out)
+        else:
+            self._apply_basis_numpy(observations, out)
+        if self.product_terms:
+            pr_terms = out[:, self._tri_i] * out[:, self._tri_j]
+            out = np.concatenate([out, pr_terms], axis=1)
+        return out
 
     def traj_to_state(self, traj):
-        return self._transform_observations(traj.obs[:])[-1,:]
+        return self._apply_basis(traj.obs[-1,:])
 
     def traj_to_states(self, traj):
         return self._transform_observations(traj.obs[:])
@@ -131,27 +214,70 @@ class Koopman(Model):
 
     @property
     def state_dim(self):
-        return len(self.basis_funcs) * self.system.obs_dim
+        N = len(self.basis) * self.system.obs_dim
+        if self.product_terms:
+            N += self._tri_i.size
+        return N
 
     def train(self, trajs, silent=False):
-        trans_obs = [self._transform_observations(traj.obs[:]) for traj in trajs]
-        X = np.concatenate([obs[:-1,:] for obs in trans_obs]).T
-        Y = np.concatenate([obs[1:,:] for obs in trans_obs]).T
-        U = np.concatenate([traj.ctrls[:-1,:] for traj in trajs]).T
-        
-        n = X.shape[0] # state dimension
-        m = U.shape[0] # control dimension    
+        # Transform each trajectory and copy its transitions straight into
+        # preallocated buffers in a single pass.  X and U are views into the
+        # stacked matrix XU, so it never has to be concatenated.
+        n = self.state_dim # state dimension
+        m = self.system.ctrl_dim # control dimension
+        total = sum(len(traj)-1 for traj in trajs)
+        XU = np.empty((total, n+m))
+        Y = np.empty((total, n))
+        off = 0
+        for traj in trajs:
+            obs = self._transform_observations(traj.obs[:])
+            L = obs.shape[0] - 1
+            XU[off:off+L, :n] = obs[:-1,:]
+            XU[off:off+L, n:] = traj.ctrls[:-1,:]
+            Y[off:off+L] = obs[1:,:]
+            off += L
+        XU, Y = XU.T, Y.T
+        X, U = XU[:n], XU[n:]
         
-        XU = np.concatenate((X, U), axis = 0) # stack X and U together
         if self.method == "lstsq": # Least Squares Solution
-            AB = np.dot(Y, sla.pinv(XU))
+            # Solve the normal equations AB (XU XU^T) = Y XU^T with a
+            # Cholesky factorization rather than forming the pseudoinverse
+            # of XU.  This squares the condition number, so it is only used
+            # when the Gram matrix is well conditioned.  Otherwise, fall back
+            # to a QR-based least squares solve (gelsy), and to the SVD-based
+            # solver (gelsd) if that fails as well.
+            G = XU @ XU.T
+            try:
+                factor = sla.cho_factor(G, check_finite=False)
+                pocon = sla.lapack.get_lapack_funcs("pocon", (G,))
+                rcond, _ = pocon(factor[0], la.norm(G, 1), 
+                        uplo="L" if factor[1] else "U")
+            except sla.LinAlgError:
+                rcond = 0.0
+            if rcond > 1e-10:
+                AB = sla.cho_solve(factor, XU @ Y.T, check_finite=False).T
+            else:
+                try:
+                    AB = sla.lstsq(XU.T, Y.T, lapack_driver="gelsy",
+                            check_finite=False)[0].T
+                except sla.LinAlgError:
+                    AB = sla.lstsq(XU.T, Y.T, lapack_driver="gelsd")[0].T
             A = AB[:n, :n]
             B = AB[:n, n:]
         elif self.method == "lasso":  # Call lasso regression on coefficients
             print("Call Lasso")
-            clf = Lasso(alpha=self.lasso_alpha)
-            clf.fit(XU.T, Y.T)
-            AB = clf.coef_
+            # Each output is an independent Lasso problem, so fit batches
+            # of outputs in parallel.  The data is centered up front (the
+            # intercept is not part of the model) so that all batches can
+            # share one precomputed Gram matrix.
+            XUc = XU.T - XU.mean(axis=1)
+            Yc = Y.T - Y.mean(axis=1)
+            gram = XUc.T @ XUc
+            n_chunks = min(effective_n_jobs(self.n_jobs), n)
+            coefs = Parallel(n_jobs=n_chunks)(
+                    delayed(_fit_lasso_chunk)(XUc, Y_chunk, self.lasso_alpha, gram)
+                    for Y_chunk in np.array_split(Yc, n_chunks, axis=1))
+            AB = np.concatenate(coefs, axis=0)
             A = AB[:n, :n]
             B = AB[:n, n:]
         elif self.method == "stable": # Compute stable A, and B
@@ -161,21 +287,40 @@ class Koopman(Model):
             A = np.real(A)
             B = np.real(B)
 
-        self.A, self.B = A, B
+        self._set_matrices(A, B)
+
+    def _set_matrices(self, A, B):
+        self.A = np.array(A, order="C")
+        self.B = np.array(B, order="C")
+        # Single precision copies used by pred_batch for float32 inputs
+        self.A32 = self.A.astype(np.float32)
+        self.B32 = self.B.astype(np.float32)
+        # pred_diff returns these without copying, so guard them against
+        # modification by callers.
+        for mat in [self.A, self.B, self.A32, self.B32]:
+            mat.flags.writeable = False
 
     def pred(self, state, ctrl):
         xpred = self.A @ state + self.B @ ctrl
         return xpred
 
     def pred_batch(self, states, ctrls):
-        statesnew = self.A @ states.T + self.B @ ctrls.T
+        # Multiply with the batch axis first so that BLAS works directly on
+        # the row-major inputs without transposed copies.  Float32 inputs
+        # are propagated in single precision.
+        if states.dtype == np.float32:
+            statesnew = states @ self.A32.T
+            statesnew += ctrls.astype(np.float32, copy=False) @ self.B32.T
+        else:
+            statesnew = states @ self.A.T
+            statesnew += ctrls @ self.B.T
 
-        return statesnew.T
+        return statesnew
 
     def pred_diff(self, state, ctrl):
         xpred = self.A @ state + self.B @ ctrl
 
-        return xpred, np.copy(self.A), np.copy(self.B)
+        return xpred, self.A, self.B
 
     def to_linear(self):
         return np.copy(self.A), np.copy(self.B)
@@ -185,5 +330,4 @@ class Koopman(Model):
                 "B" : np.copy(self.B)}
 
     def set_parameters(self, params):
-        self.A = np.copy(params["A"])
-        self.B = np.copy(params["B"])
+        self._set_matrices(params["A"], params["B"])
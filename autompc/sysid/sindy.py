@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import numpy.linalg as la
 import scipy.linalg as sla
@@ -14,6 +16,30 @@ import pysindy.differentiation as psd
 
 from .basis_funcs import *
 
+@functools.lru_cache(maxsize=None)
+def _build_library(poly_basis, poly_degree, poly_cross_terms, trig_basis, 
+        trig_freq, trig_interaction):
+    """
+    Returns the tuple of basis functions for a SINDy library configuration.
+    The basis functions are stateless, so the result is cached and shared
+    between models with the same configuration.
+    """
+    #basis_funcs = [get_constant_basis_func(), get_identity_basis_func()]
+    basis_funcs = [get_identity_basis_func()]
+    if trig_basis:
+        for freq in range(1,trig_freq+1):
+            basis_funcs += get_trig_basis_funcs(freq)
+            if trig_interaction:
+                basis_funcs += get_trig_interaction_terms(freq)
+
+    if poly_basis:
+        for deg in range(2,poly_degree+1):
+            basis_funcs.append(get_poly_basis_func(deg))
+        if poly_cross_terms:
+            for deg in range(2,poly_degree+1):
+                basis_funcs += get_cross_term_basis_funcs(deg)
+    return tuple(basis_funcs)
+
 class FourthOrderFiniteDifference(psd.base.BaseDifferentiation):
     def _differentiate(self, x, t):
         fd = psd.FiniteDifference(order=2)
@@ -131,26 +157,14 @@ class SINDy(Model):
         X = [traj.obs for traj in trajs]
         U = [traj.ctrls for traj in trajs]
 
-        #basis_funcs = [get_constant_basis_func(), get_identity_basis_func()]
-        basis_funcs = [get_identity_basis_func()]
-        if self.trig_basis:
-            for freq in range(1,self.trig_freq+1):
-                basis_funcs += get_trig_basis_funcs(freq)
-                if self.trig_interaction:
-                    basis_funcs += get_trig_interaction_terms(freq)
-
-        if self.poly_basis:
-            for deg in range(2,self.poly_degree+1):
-                basis_funcs.append(get_poly_basis_func(deg))
-            if self.poly_cross_terms:
-                for deg in range(2,self.poly_degree+1):
-                    basis_funcs += get_cross_term_basis_funcs(deg)
-
+        basis_funcs = _build_library(self.poly_basis, self.poly_degree,
+                self.poly_cross_terms, self.trig_basis, self.trig_freq,
+                self.trig_interaction)
         library_functions = [basis.func for basis in basis_funcs]
         function_names = [basis.name_func for basis in basis_funcs]
         library = ps.CustomLibrary(library_functions=library_functions,
                 function_names=function_names)
-        self.basis_funcs = basis_funcs
+        self.basis_funcs = list(basis_funcs)
 
         if self.time_mode == "continuous":
             sindy_model = ps.SINDy(feature_library=library, 
@@ -164,6 +178,7 @@ class SINDy(Model):
                     optimizer=ps.STLSQ(threshold=self.threshold))
             sindy_model.fit(X, u=U, multiple_trajectories=True)
         self.model = sindy_model
+        self._build_gradient_tables()
 
     def pred(self, state, ctrl):
         xpred = self.pred_batch(state.reshape((1,state.size)), 
@@ -179,67 +194,125 @@ class SINDy(Model):
         return xpreds
 
     def pred_diff(self, state, ctrl):
-        pred, state_jac, ctrl_jac = self.pred_diff_batch(
-                state.reshape((1,-1)), ctrl.reshape((1,-1)))
-        pred = pred[0]
-        state_jac = state_jac[0]
-        ctrl_jac = ctrl_jac[0]
-        return pred, state_jac, ctrl_jac
-
-    def compute_gradient(self, states, ctrls, basis, coeff, feat_names):
+        if not self._tables_complete:
+            pred, state_jac, ctrl_jac = self.pred_diff_batch(
+                    state.reshape((1,-1)), ctrl.reshape((1,-1)))
+            return pred[0], state_jac[0], ctrl_jac[0]
+
+        # Evaluate the prediction and jacobian of a single sample directly
+        # from the gradient tables, bypassing pysindy's predict.
+        inputs = np.concatenate([state, ctrl]).reshape((1,-1))
+        xpred = np.zeros(self.state_dim)
+        jac = np.zeros(self.state_dim * inputs.size)
+        for basis, arg_idxs, coeffs, weights in self._grad_tables:
+            vals = [inputs[0,arg_idxs[:,j]] for j in range(basis.n_args)]
+            xpred += coeffs @ np.broadcast_to(basis.func(*vals), 
+                    (arg_idxs.shape[0],))
+            jac += self.compute_gradient(inputs, basis, arg_idxs, weights)[0]
+        jac = jac.reshape((self.state_dim, inputs.size))
+        state_jac = jac[:,:self.state_dim]
+        ctrl_jac = jac[:,self.state_dim:]
+        if self.time_mode == "continuous":
+            xpred = state + self.system.dt * xpred
+            state_jac = np.eye(self.state_dim) + self.system.dt * state_jac
+            ctrl_jac = self.system.dt * ctrl_jac
+        return xpred, state_jac, ctrl_jac
+
+    def _build_gradient_tables(self):
+        """
+        For each basis function, find the model features it generates and
+        record the input indices of each feature's arguments.  The feature
+        coefficients are scattered into a weight matrix mapping the stacked
+        feature gradients to the flattened jacobian, so pred_diff_batch
+        needs one vectorized gradient call and one matrix product per basis.
+        """
         input_dim = self.state_dim + self.system.ctrl_dim
-        idxs = np.mgrid[tuple(slice(input_dim) 
-                                for _ in range(basis.n_args))]
-        idxs = idxs.reshape((basis.n_args, -1))
-        p = states.shape[0]
-        state_jac = np.zeros((p,self.state_dim))
-        ctrl_jac = np.zeros((p,self.system.ctrl_dim))
-        for i in range(idxs.shape[1]):
-            # Find feature
-            var_names = ["x{}".format(j) if j < self.state_dim else 
-                    "u{}".format(j-self.state_dim) for j in idxs[:,i]]
-            feat_name = basis.name_func(*var_names)
-            try:
-                coeff_idx = feat_names.index(feat_name)
-            except ValueError:
+        feat_idxs = {name : i for i, name 
+                in enumerate(self.model.get_feature_names())}
+        self._coeffs = self.model.coefficients()
+        self._grad_tables = []
+        covered = set()
+        for basis in self.basis_funcs:
+            idxs = np.mgrid[tuple(slice(input_dim) 
+                                    for _ in range(basis.n_args))]
+            idxs = idxs.reshape((basis.n_args, -1))
+            arg_idxs = []
+            coeff_idxs = []
+            for i in range(idxs.shape[1]):
+                var_names = ["x{}".format(j) if j < self.state_dim else 
+                        "u{}".format(j-self.state_dim) for j in idxs[:,i]]
+                feat_name = basis.name_func(*var_names)
+                # Features eliminated by the sparse regression do not
+                # contribute to the gradient.  Some features can be generated
+                # by more than one basis function (e.g. the two orderings of
+                # the trig interaction terms), so only count each once.
+                if (feat_name in feat_idxs 
+                        and not feat_idxs[feat_name] in covered
+                        and np.any(self._coeffs[:,feat_idxs[feat_name]])):
+                    arg_idxs.append(idxs[:,i])
+                    coeff_idxs.append(feat_idxs[feat_name])
+                    covered.add(feat_idxs[feat_name])
+            # Bases which contribute no features (e.g. trig interaction
+            # terms when trig_interaction is off) are skipped entirely.
+            if not coeff_idxs:
                 continue
+            arg_idxs = np.array(arg_idxs, dtype=int)
+            n_feats = len(coeff_idxs)
+            weights = np.zeros((basis.n_args, n_feats, self.state_dim, 
+                input_dim))
+            for j in range(basis.n_args):
+                weights[j, np.arange(n_feats), :, arg_idxs[:,j]] = \
+                        self._coeffs[:,coeff_idxs].T
+            weights = weights.reshape((basis.n_args * n_feats, -1))
+            self._grad_tables.append((basis, arg_idxs, 
+                self._coeffs[:,coeff_idxs], weights))
+        # The tables can be used for prediction as well, provided they account
+        # for every feature with a nonzero coefficient.
+        self._tables_complete = (covered == 
+                set(np.flatnonzero(np.any(self._coeffs, axis=0))))
+
+    def compute_gradient(self, inputs, basis, arg_idxs, weights):
+        """
+        Compute the contribution of one basis function to the model jacobian
+        for every output dimension at once.
 
-            # Compute gradient
-            vals = []
-            for j in range(idxs.shape[0]):
-                idx = idxs[j,i]
-                if idx < self.state_dim:
-                    val = states[:,idx]
-                else:
-                    val = ctrls[:,idx-self.state_dim]
-                vals.append(val)
-            grads = basis.grad_func(*vals)
-            grads = np.array(grads)
-            for j in range(idxs.shape[0]):
-                idx = idxs[j,i]
-                if idx < self.state_dim:
-                    state_jac[:,idx] += coeff[coeff_idx] * grads[j]
-                else:
-                    ctrl_jac[:,idx-self.state_dim] += coeff[coeff_idx] * grads[j]
-        return state_jac, ctrl_jac
+        Parameters
+        ----------
+            inputs : Numpy array of shape (N, self.state_dim + self.system.ctrl_dim)
+                Concatenated model states and controls
+            basis : BasisFunction
+                Basis function to differentiate
+            arg_idxs : Numpy array of shape (n_feats, basis.n_args)
+                Input indices of the arguments of each feature
+            weights : Numpy array of shape (basis.n_args * n_feats,
+                      self.state_dim * (self.state_dim + self.system.ctrl_dim))
+                Map from feature gradients to flattened jacobian
+        Returns
+        -------
+            jac : Numpy array of shape (N, self.state_dim * 
+                  (self.state_dim + self.system.ctrl_dim))
+                Flattened gradient of predicted state wrt to states and controls
+        """
+        p = inputs.shape[0]
+        n_feats = arg_idxs.shape[0]
+        vals = [inputs[:,arg_idxs[:,j]] for j in range(basis.n_args)]
+        grads = basis.grad_func(*vals)
+        grads = np.concatenate([np.broadcast_to(grads[j], (p, n_feats))
+            for j in range(basis.n_args)], axis=1)
+        return grads @ weights
 
     def pred_diff_batch(self, states, ctrls):
         xpred = self.pred_batch(states, ctrls)
         p = states.shape[0]
-        state_jac = np.zeros((p, self.state_dim, self.state_dim))
-        ctrl_jac = np.zeros((p, self.state_dim, self.system.ctrl_dim))
-        coeffs = self.model.coefficients()
-        feat_names = self.model.get_feature_names()
-        for i in range(self.state_dim):
-            for basis in self.basis_funcs:
-                sj, cj = self.compute_gradient(
-                        states, ctrls, basis, coeffs[i,:], feat_names)
-                state_jac[:,i,:] += sj
-                ctrl_jac[:,i,:] += cj
+        inputs = np.concatenate([states, ctrls], axis=1)
+        jac = np.zeros((p, self.state_dim * inputs.shape[1]))
+        for basis, arg_idxs, _, weights in self._grad_tables:
+            jac += self.compute_gradient(inputs, basis, arg_idxs, weights)
+        jac = jac.reshape((p, self.state_dim, inputs.shape[1]))
+        state_jac = jac[:,:,:self.state_dim]
+        ctrl_jac = jac[:,:,self.state_dim:]
         if self.time_mode == "continuous":
-            ident = np.array([np.eye(self.state_dim) for _ in
-                range(p)])
-            state_jac = ident + self.system.dt * state_jac
+            state_jac = np.eye(self.state_dim) + self.system.dt * state_jac
             ctrl_jac = self.system.dt * ctrl_jac
         return xpred, state_jac, ctrl_jac
 
@@ -0,0 +1,146 @@
+# Standard library includes
+import unittest
+
+# Internal library includes
+import autompc as ampc
+from autompc.sysid import Koopman
+from .utils import random_trajs
+
+# External library includes
+import numpy as np
+
+class KoopmanTest(unittest.TestCase):
+    def setUp(self):
+        simple_sys = ampc.System(["x", "y"], ["u"])
+        simple_sys.dt = 0.05
+        self.system = simple_sys
+        rng = np.random.default_rng(42)
+        self.trajs = random_trajs(self.system, rng, traj_len=20, n_trajs=10)
+
+    def test_transform_observations(self):
+        model = Koopman(self.system, "lstsq", poly_basis="true", poly_degree=3,
+                trig_basis="true", trig_freq=2)
+        obs = self.trajs[0].obs
+        basis_funcs = [lambda x: x, lambda x: x**2, lambda x: x**3,
+                lambda x: np.sin(x), lambda x: np.cos(x),
+                lambda x: np.sin(2*x), lambda x: np.cos(2*x)]
+        expected = np.concatenate([b(obs) for b in basis_funcs], axis=1)
+
+        trans_obs = model._transform_observations(obs)
+        self.assertEqual(trans_obs.shape, (obs.shape[0], model.state_dim))
+        self.assertTrue(np.allclose(trans_obs, expected))
+        self.assertTrue(np.allclose(model._apply_basis(obs[5]), expected[5]))
+        self.assertTrue(np.allclose(model.traj_to_state(self.trajs[0]),
+            expected[-1]))
+
+    def test_product_terms(self):
+        model = Koopman(self.system, "lstsq", poly_basis="true", poly_degree=2,
+                product_terms="true")
+        obs = self.trajs[0].obs
+        lifted = np.concatenate([obs, obs**2], axis=1)
+        pr_terms = [lifted[:,i] * lifted[:,j] for i in range(4) 
+                for j in range(i+1, 4)]
+        expected = np.concatenate([lifted, np.array(pr_terms).T], axis=1)
+
+        trans_obs = model._transform_observations(obs)
+        self.assertEqual(model.state_dim, 10)
+        self.assertTrue(np.allclose(trans_obs, expected))
+        self.assertTrue(np.allclose(model._apply_basis(obs[3]), expected[3]))
+
+    def test_apply_basis_numpy(self):
+        model = Koopman(self.system, "lstsq", poly_basis="true", poly_degree=4,
+                trig_basis="true", trig_freq=3)
+        obs = self.trajs[0].obs
+        out = np.empty((obs.shape[0], model.state_dim))
+        model._apply_basis_numpy(obs, out)
+        self.assertTrue(np.allclose(out, model._transform_observations(obs)))
+
+    def test_train_lstsq(self):
+        A = np.array([[1.0, 0.05], [-0.1, 0.9]])
+        B = np.array([[0.0], [0.05]])
+        for traj in self.trajs:
+            for i in range(len(traj) - 1):
+                traj.obs[i+1] = A @ traj.obs[i] + B @ traj.ctrls[i]
+
+        model = Koopman(self.system, "lstsq")
+        model.train(self.trajs)
+        self.assertTrue(np.allclose(model.A, A))
+        self.assertTrue(np.allclose(model.B, B))
+
+    def test_train_lstsq_rank_deficient(self):
+        # With zero controls the Gram matrix is singular, so training must
+        # fall back to the least squares solver.
+        A = np.array([[1.0, 0.05], [-0.1, 0.9]])
+        for traj in self.trajs:
+            traj.ctrls[:] = 0.0
+            for i in range(len(traj) - 1):
+                traj.obs[i+1] = A @ traj.obs[i]
+
+        model = Koopman(self.system, "lstsq")
+        model.train(self.trajs)
+        self.assertTrue(np.allclose(model.A, A))
+        self.assertTrue(np.allclose(model.B, 0.0))
+
+    def test_train_lstsq_ill_conditioned(self):
+        # The lifted data has cond(XU) of about 2e6, where solving the normal
+        # equations would lose most of the available precision.
+        A = np.array([[1.0, 0.05], [-0.1, 0.9]])
+        B = np.array([[0.0], [0.05]])
+        for traj in self.trajs:
+            for i in range(len(traj) - 1):
+                traj.obs[i+1] = A @ traj.obs[i] + B @ traj.ctrls[i]
+
+        model = Koopman(self.system, "lstsq", poly_basis="true", poly_degree=3,
+                trig_basis="true", trig_freq=2)
+        model.train(self.trajs)
+
+        trans_obs = [model._transform_observations(traj.obs) 
+                for traj in self.trajs]
+        XU = np.concatenate([np.concatenate([obs[:-1], traj.ctrls[:-1]], axis=1)
+            for obs, traj in zip(trans_obs, self.trajs)])
+        Y = np.concatenate([obs[1:] for obs in trans_obs])
+        cond = np.linalg.cond(XU)
+        self.assertTrue(1e6 < cond < 1e7)
+        AB = np.linalg.lstsq(XU, Y, rcond=None)[0].T
+        AB_model = np.concatenate([model.A, model.B], axis=1)
+        self.assertLess(np.linalg.norm(AB_model - AB) / np.linalg.norm(AB), 1e-8)
+
+    def test_pred_batch_float32(self):
+        model = Koopman(self.system, "lstsq", poly_basis="true", poly_degree=2)
+        model.train(self.trajs)
+        states = model.traj_to_states(self.trajs[0])
+        ctrls = self.trajs[0].ctrls
+
+        preds = model.pred_batch(states, ctrls)
+        preds32 = model.pred_batch(states.astype(np.float32), 
+                ctrls.astype(np.float32))
+        self.assertEqual(preds32.dtype, np.float32)
+        self.assertTrue(np.allclose(preds32, preds, atol=1e-4))
+        self.assertTrue(np.allclose(preds[3], 
+            model.pred(states[3], ctrls[3])))
+
+    def test_pred_diff_read_only(self):
+        model = Koopman(self.system, "lstsq")
+        model.train(self.trajs)
+        _, state_jac, ctrl_jac = model.pred_diff(self.trajs[0].obs[0],
+                self.trajs[0].ctrls[0])
+        self.assertFalse(state_jac.flags.writeable)
+        self.assertFalse(ctrl_jac.flags.writeable)
+
+        A, B = model.to_linear()
+        A[0, 0] += 1.0
+        self.assertFalse(np.array_equal(A, model.A))
+
+    def test_train_lasso_offset(self):
+        # Observations with a large mean relative to their spread, for which
+        # centering the Gram matrix after the fact loses precision.
+        rng = np.random.default_rng(0)
+        for offset in [300.0, 1000.0]:
+            for traj in self.trajs:
+                traj.obs[:] = offset + 0.01 * rng.uniform(-1.0, 1.0, 
+                        traj.obs.shape)
+            model = Koopman(self.system, "lasso", lasso_alpha=1e-6, 
+                    poly_basis="true", poly_degree=2)
+            model.train(self.trajs)
+            self.assertTrue(np.all(np.isfinite(model.A)))
+            self.assertTrue(np.all(np.isfinite(model.B)))
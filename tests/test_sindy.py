@@ -0,0 +1,154 @@
+# Standard library includes
+import unittest
+
+# Internal library includes
+import autompc as ampc
+from autompc.sysid import SINDy
+from .utils import random_trajs, simulate_linear
+
+# External library includes
+import numpy as np
+
+class SINDyTest(unittest.TestCase):
+    def setUp(self):
+        simple_sys = ampc.System(["x", "y"], ["u"])
+        simple_sys.dt = 0.05
+        self.system = simple_sys
+        self.rng = np.random.default_rng(42)
+        self.trajs = random_trajs(self.system, self.rng, traj_len=50, n_trajs=20)
+
+    def finite_difference_jacs(self, model, states, ctrls, eps=1e-6):
+        state_jacs = np.array([(model.pred_batch(states + eps * e, ctrls)
+            - model.pred_batch(states - eps * e, ctrls)) / (2 * eps)
+            for e in np.eye(self.system.obs_dim)])
+        ctrl_jacs = np.array([(model.pred_batch(states, ctrls + eps * e)
+            - model.pred_batch(states, ctrls - eps * e)) / (2 * eps)
+            for e in np.eye(self.system.ctrl_dim)])
+        return state_jacs.transpose((1, 2, 0)), ctrl_jacs.transpose((1, 2, 0))
+
+    def check_pred_diff_batch(self, model):
+        states = self.rng.uniform(-1.0, 1.0, (5, self.system.obs_dim))
+        ctrls = self.rng.uniform(-1.0, 1.0, (5, self.system.ctrl_dim))
+        preds, state_jacs, ctrl_jacs = model.pred_diff_batch(states, ctrls)
+        self.assertTrue(np.allclose(preds, model.pred_batch(states, ctrls)))
+
+        fd_state_jacs, fd_ctrl_jacs = self.finite_difference_jacs(model,
+                states, ctrls)
+        self.assertTrue(np.allclose(state_jacs, fd_state_jacs, atol=1e-6))
+        self.assertTrue(np.allclose(ctrl_jacs, fd_ctrl_jacs, atol=1e-6))
+
+    def test_pred_diff_batch_poly(self):
+        model = SINDy(self.system, "lstsq", threshold=1e-4, poly_basis="true",
+                poly_degree=3, poly_cross_terms="true")
+        model.train(self.trajs)
+        self.check_pred_diff_batch(model)
+
+    def test_pred_diff_batch_trig(self):
+        model = SINDy(self.system, "lstsq", threshold=1e-4, trig_basis="true",
+                trig_freq=2, trig_interaction="true")
+        model.train(self.trajs)
+        self.check_pred_diff_batch(model)
+
+    def test_pred_diff_batch_continuous(self):
+        model = SINDy(self.system, "lstsq", threshold=1e-4, poly_basis="true",
+                poly_degree=2, trig_basis="true", time_mode="continuous")
+        model.train(self.trajs)
+        self.check_pred_diff_batch(model)
+
+    def check_pred_diff(self, model):
+        state = self.rng.uniform(-1.0, 1.0, self.system.obs_dim)
+        ctrl = self.rng.uniform(-1.0, 1.0, self.system.ctrl_dim)
+        pred, state_jac, ctrl_jac = model.pred_diff(state, ctrl)
+        self.assertTrue(np.allclose(pred, model.pred(state, ctrl)))
+
+        preds, state_jacs, ctrl_jacs = model.pred_diff_batch(state[None],
+                ctrl[None])
+        self.assertTrue(np.allclose(state_jacs[0], state_jac))
+        self.assertTrue(np.allclose(ctrl_jacs[0], ctrl_jac))
+
+    def test_pred_diff(self):
+        for kwargs in [dict(poly_basis="true", poly_degree=3, 
+                            poly_cross_terms="true"),
+                       dict(trig_basis="true", trig_freq=2, 
+                            trig_interaction="true"),
+                       dict(poly_basis="true", poly_degree=2, 
+                            trig_basis="true", time_mode="continuous")]:
+            model = SINDy(self.system, "lstsq", threshold=1e-4, **kwargs)
+            model.train(self.trajs)
+            self.assertTrue(model._tables_complete)
+            self.check_pred_diff(model)
+
+    def test_pred_diff_batch_linear(self):
+        # Every output row of the jacobian should recover the dynamics of a
+        # linear system at every sample in the batch.
+        A = np.array([[1.0, 0.05], [-0.1, 0.9]])
+        B = np.array([[0.0], [0.05]])
+        simulate_linear(self.trajs, A, B)
+        model = SINDy(self.system, "lstsq", threshold=1e-4)
+        model.train(self.trajs)
+
+        states = self.rng.uniform(-1.0, 1.0, (7, self.system.obs_dim))
+        ctrls = self.rng.uniform(-1.0, 1.0, (7, self.system.ctrl_dim))
+        _, state_jacs, ctrl_jacs = model.pred_diff_batch(states, ctrls)
+        self.assertEqual(state_jacs.shape, (7, 2, 2))
+        self.assertEqual(ctrl_jacs.shape, (7, 2, 1))
+        self.assertTrue(np.allclose(state_jacs, A, atol=1e-6))
+        self.assertTrue(np.allclose(ctrl_jacs, B, atol=1e-6))
+
+    def test_gradient_tables(self):
+        # Each gradient table entry must refer to the feature whose
+        # coefficients it carries.
+        model = SINDy(self.system, "lstsq", threshold=1e-4, poly_basis="true",
+                poly_degree=3, poly_cross_terms="true")
+        model.train(self.trajs)
+        feat_names = model.model.get_feature_names()
+        coeffs = model.model.coefficients()
+        var_names = ["x0", "x1", "u0"]
+        n_entries = 0
+        for basis, arg_idxs, table_coeffs, _ in model._grad_tables:
+            for args, coeff in zip(arg_idxs, table_coeffs.T):
+                name = basis.name_func(*[var_names[i] for i in args])
+                self.assertTrue(np.array_equal(coeff, 
+                    coeffs[:, feat_names.index(name)]))
+                n_entries += 1
+        self.assertEqual(n_entries, np.count_nonzero(np.any(coeffs, axis=0)))
+
+    def test_gradient_tables_skip_inactive(self):
+        # On data from a linear system the nonlinear features are pruned by
+        # the threshold, and without trig interaction terms only bases with
+        # active features should remain.
+        A = np.array([[1.0, 0.05], [-0.1, 0.9]])
+        B = np.array([[0.0], [0.05]])
+        simulate_linear(self.trajs, A, B)
+        model = SINDy(self.system, "lstsq", threshold=0.01, poly_basis="true",
+                poly_degree=3, trig_basis="true", trig_freq=2)
+        model.train(self.trajs)
+        coeffs = model.model.coefficients()
+        self.assertLess(np.count_nonzero(np.any(coeffs, axis=0)), 
+                coeffs.shape[1])
+        self.assertLess(len(model._grad_tables), len(model.basis_funcs))
+        for basis, arg_idxs, table_coeffs, _ in model._grad_tables:
+            self.assertEqual(basis.n_args, 1)
+            self.assertGreater(arg_idxs.shape[0], 0)
+            self.assertTrue(np.all(np.any(table_coeffs, axis=0)))
+        self.check_pred_diff_batch(model)
+
+    def test_compute_gradient(self):
+        # Compare the weight matrix contraction with a direct accumulation
+        # over features, including two-argument trig interaction features.
+        model = SINDy(self.system, "lstsq", threshold=1e-4, trig_basis="true",
+                trig_freq=2, trig_interaction="true")
+        model.train(self.trajs)
+        inputs = self.rng.uniform(-1.0, 1.0, (6, 3))
+        for basis, arg_idxs, coeffs, weights in model._grad_tables:
+            expected = np.zeros((6, 2, 3))
+            vals = [inputs[:,arg_idxs[:,j]] for j in range(basis.n_args)]
+            grads = basis.grad_func(*vals)
+            for j in range(basis.n_args):
+                grad = np.broadcast_to(grads[j], (6, arg_idxs.shape[0]))
+                for f, idx in enumerate(arg_idxs[:,j]):
+                    expected[:,:,idx] += np.outer(grad[:,f], coeffs[:,f])
+            jac = model.compute_gradient(inputs, basis, arg_idxs, weights)
+            self.assertTrue(np.allclose(jac.reshape((6, 2, 3)), expected))
+        self.assertTrue(any(basis.n_args == 2 
+            for basis, _, _, _ in model._grad_tables))
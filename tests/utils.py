@@ -0,0 +1,26 @@
+# Shared helpers for the test suite
+
+# Internal library includes
+import autompc as ampc
+
+def random_trajs(system, rng, traj_len, n_trajs):
+    """
+    Generate trajectories with observations and controls drawn uniformly
+    from [-1, 1].
+    """
+    trajs = []
+    for _ in range(n_trajs):
+        traj = ampc.zeros(system, traj_len)
+        traj.obs[:] = rng.uniform(-1.0, 1.0, (traj_len, system.obs_dim))
+        traj.ctrls[:] = rng.uniform(-1.0, 1.0, (traj_len, system.ctrl_dim))
+        trajs.append(traj)
+    return trajs
+
+def simulate_linear(trajs, A, B):
+    """
+    Overwrite the observations of trajs, after the first, with the response
+    of the linear system x[t+1] = A x[t] + B u[t] to their controls.
+    """
+    for traj in trajs:
+        for i in range(len(traj) - 1):
+            traj.obs[i+1] = A @ traj.obs[i] + B @ traj.ctrls[i]